@@ -25,13 +25,12 @@ v0.3.0 - Jun 2023, Replace st.experimental_singleton with st.cache_resource
 
 import io
 import json
-import math
-import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 
-from PIL import Image, ImageStat
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google.oauth2 import service_account
+import numpy as np
 import streamlit as st
 
 __author__ = "Terry Dolan"
@@ -51,26 +50,87 @@ st.set_page_config(
     }
 )
 
-# define the google drive file id of the root 'catmon-pics' folder
-CATMON_PICS_FOLDER_ID = st.secrets["CATMON_PICS_FOLDER_ID"]
-
-# define a dict to hold the tag folder ids on my google drive
-# the parent of these folders is the root catmon-pics folder
-tag_folder_ids_d = {
-    # MyDrive:/catmon-pics/boo_images
-    'Boo': st.secrets["BOO_FOLDER_ID"],
-    # MyDrive:/catmon-pics/simba_images
-    'Simba': st.secrets["SIMBA_FOLDER_ID"],
-    # MyDrive:/catmon-pics/auto_discard_images
-    'Auto-Discard': st.secrets["AUTO_DISCARD_FOLDER_ID"],
-    # MyDrive:/catmon-pics/unclear_images
-    'Unclear': st.secrets["UNCLEAR_FOLDER_ID"]
-    }
+@st.cache_resource
+def config():
+    """Return the app configuration read from the streamlit secrets.
+
+    The secrets are read once and shared by all runs and sessions."""
+    # define the google drive file id of the root 'catmon-pics' folder
+    catmon_pics_folder_id = st.secrets["CATMON_PICS_FOLDER_ID"]
+
+    # define the drive query for the untagged images in the root folder
+    # the filters are applied server side, so trashed and non jpeg files
+    # are never returned
+    catmon_pics_query = (
+        f"'{catmon_pics_folder_id}' in parents and mimeType='image/jpeg' "
+        "and trashed=false"
+        )
+
+    # define a dict to hold the tag folder ids on my google drive
+    # the parent of these folders is the root catmon-pics folder
+    tag_folder_ids_d = {
+        # MyDrive:/catmon-pics/boo_images
+        'Boo': st.secrets["BOO_FOLDER_ID"],
+        # MyDrive:/catmon-pics/simba_images
+        'Simba': st.secrets["SIMBA_FOLDER_ID"],
+        # MyDrive:/catmon-pics/auto_discard_images
+        'Auto-Discard': st.secrets["AUTO_DISCARD_FOLDER_ID"],
+        # MyDrive:/catmon-pics/unclear_images
+        'Unclear': st.secrets["UNCLEAR_FOLDER_ID"]
+        }
+
+    return SimpleNamespace(
+        catmon_pics_folder_id=catmon_pics_folder_id,
+        catmon_pics_query=catmon_pics_query,
+        tag_folder_ids_d=tag_folder_ids_d,
+        password=st.secrets["CATMON_PASSWORD"]
+        )
 
 # define image brightness threshold
 # any images darker than this threshold will be auto discarded
 IMAGE_BRIGHTNESS_THRESHOLD = 25
 
+# define the perceived brightness weights of the red, green and blue channels
+BRIGHTNESS_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# define the margin either side of the threshold within which the brightness
+# estimated from the embedded exif thumbnail is not trusted
+IMAGE_BRIGHTNESS_MARGIN = 5
+
+# define the number of bytes read from the start of an image to find the
+# embedded exif thumbnail, the exif segment is limited to 64 KiB
+IMAGE_HEAD_SIZE = 64*1024
+
+# define the maximum size of the image shown to the user
+# the image column is narrower than this
+IMAGE_DISPLAY_SIZE = (800, 800)
+
+# define the number of times a drive request is retried
+# the google api client retries with exponential backoff on 5xx, 429 and
+# rate limit 403 responses
+DRIVE_NUM_RETRIES = 5
+
+# define the drive connection timeout (in seconds)
+DRIVE_TIMEOUT = 30
+
+# define the drive download chunk size (in bytes)
+# a catmon image is typically downloaded in one or two chunks
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+
+# define the number of pending tags that triggers a save to google drive
+PENDING_TAGS_FLUSH_SIZE = 10
+
+# define the pause in tagging (in seconds) after which the pending tags are
+# saved to google drive, even if the user has left the app
+PENDING_TAGS_PAUSE = 30
+
+# define the number of recently tagged image ids that are remembered
+# google drive may list a moved image for a short time after the move
+RECENT_IMAGE_IDS_SIZE = 16
+
+# define how long to wait (in seconds) for a prefetched image
+PREFETCH_TIMEOUT = 30
+
 # initialise session stats data
 if "stats" not in st.session_state:
     # First run, initialise
@@ -108,6 +168,21 @@ if "previous_tag" not in st.session_state:
         }
     st.session_state["previous_tag"] = previous_tag_d
 
+# initialise session pending tag data
+if "pending_tags" not in st.session_state:
+    # First run, initialise
+
+    # setup session list to hold the tags not yet saved to google drive
+    # each pending tag is a dictionary of the image id, tag and folder ids
+    st.session_state["pending_tags"] = []
+
+# initialise session recent image id data
+if "recent_image_ids" not in st.session_state:
+    # First run, initialise
+
+    # setup session deque to hold the ids of the recently tagged images
+    st.session_state["recent_image_ids"] = deque(maxlen=RECENT_IMAGE_IDS_SIZE)
+
 def check_password():
     """Returns True if the user enters the correct catmon_password.
 
@@ -115,13 +190,14 @@ def check_password():
     """
     def password_entered():
         """Checks whether a password entered by the user is correct."""
-        if st.session_state["password"] == st.secrets["CATMON_PASSWORD"]:
+        if st.session_state["password"] == config().password:
             st.session_state["password_correct"] = True
             del st.session_state["password"]  # don't store password
         else:
             st.session_state["password_correct"] = False
 
-    if "password_correct" not in st.session_state:
+    password_correct = st.session_state.get("password_correct")
+    if password_correct is None:
         # First run, show input for password
         st.text_input(
             "Password",
@@ -130,7 +206,7 @@ def check_password():
             key="password"
         )
         return False
-    elif not st.session_state["password_correct"]:
+    elif not password_correct:
         # Password not correct, show input + error
         st.text_input(
             "Password",
@@ -146,7 +222,19 @@ def check_password():
 
 @st.cache_resource
 def gdrive_connect():
-    """Connect to google drive service"""
+    """Connect to google drive service.
+
+    The service uses a single authorized http object, so the connection
+    to google drive is kept open and reused by every request.
+
+    Return the drive service and its files collection, the collection is
+    reused for every files request."""
+    # import the google api modules on first use, the connection is cached
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+    from google.oauth2 import service_account
+
     print("call to gdrive_connect()")
 
     # load json authentication string from environment variable
@@ -160,11 +248,38 @@ def gdrive_connect():
     creds = service_account.Credentials.from_service_account_info(
         service_account_info,
         scopes=SCOPES)
-    drive_service = build('drive', 'v3', credentials=creds)
+    authed_http = AuthorizedHttp(
+        creds,
+        http=httplib2.Http(timeout=DRIVE_TIMEOUT))
+    drive_service = build('drive', 'v3', http=authed_http,
+                          static_discovery=True)
+
+    return drive_service, drive_service.files()
 
-    return drive_service
+@st.cache_resource
+def prefetch_executor():
+    """Return the thread pool used to prefetch the next image"""
+    return ThreadPoolExecutor(max_workers=2)
 
-def tag_image(image_name, image_id, tag_name):
+@st.cache_resource
+def drive_lock():
+    """Return the lock that serialises use of the shared drive service.
+
+    The drive service is not thread safe and is shared with the prefetch
+    thread. The lock is held for a single drive request at a time."""
+    return threading.Lock()
+
+@st.cache_resource
+def pending_tags_lock():
+    """Return the lock that serialises changes to the pending tags.
+
+    The pending tags are saved by the pause timer thread as well as by the
+    app, see schedule_pending_tags_save()."""
+    return threading.Lock()
+
+def tag_image(image_name, image_id, tag_name, stats, consec, previous_tag,
+              pending_tags, recent_image_ids, cfg,
+              curr_parent_folder_id=None):
     """Tag given image with given tag.
 
     Tagging is achieved by moving the given image to the
@@ -172,113 +287,430 @@ def tag_image(image_name, image_id, tag_name):
     """
     print(f'\tDEBUG: {image_name} ({image_id}), {tag_name}')
 
-    # set current parent folder id
-    image_parents = drive_service.files().get(fileId=image_id,
-                                     fields='parents').execute()
-    curr_parent_folder_id = ",".join(image_parents.get('parents'))
-
-    # set new parent folder id
-    new_parent_folder_id = tag_folder_ids_d[tag_name]
-
-    try:
-        # Move the image file to the selected tag folder
-        drive_service.files().update(
-            fileId=image_id,
-            addParents=new_parent_folder_id,
-            removeParents=curr_parent_folder_id,
-            fields='id, parents').execute()
-    except Exception as e:
-        st.error(f"Unexpected error encountered: {e}")
-        return
-
+    # set current and new parent folder ids
+    if curr_parent_folder_id is None:
+        curr_parent_folder_id = cfg.catmon_pics_folder_id
+    new_parent_folder_id = cfg.tag_folder_ids_d[tag_name]
+
+    # queue the move, the pending tags are saved in a batch when there are
+    # enough of them or when tagging pauses, see schedule_pending_tags_save()
+    with pending_tags_lock():
+        pending_tags.append({
+            'image_id': image_id,
+            'tag_name': tag_name,
+            'new_parent_folder_id': new_parent_folder_id,
+            'curr_parent_folder_id': curr_parent_folder_id
+            })
 
     # update session data
-    if tag_name == st.session_state["consec"]["name"]:
+    if tag_name == consec["name"]:
         # consecutive tagging continues
-        st.session_state["consec"]["tot"] += 1
+        consec["tot"] += 1
     else:
         # new tagging starts
-        st.session_state["consec"]["name"] = tag_name
-        st.session_state["consec"]["tot"] = 1
+        consec["name"] = tag_name
+        consec["tot"] = 1
+
+    stats[tag_name] += 1
+    previous_tag["image_name"] = image_name
+    previous_tag["image_id"] = image_id
+    previous_tag["tag_name"] = tag_name
+    recent_image_ids.append(image_id)
+
+    if len(pending_tags) >= PENDING_TAGS_FLUSH_SIZE:
+        commit_pending_tags(stats, consec, previous_tag, pending_tags,
+                            recent_image_ids)
+
+def is_transient_drive_error(error):
+    """Return True if the given drive request error may succeed on retry.
+
+    Transport errors, 429, 5xx and rate limit 403 responses are transient,
+    any other http error, e.g. 404 for a deleted image, is permanent.
+    """
+    from googleapiclient.errors import HttpError
+
+    RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
 
-    st.session_state["stats"][tag_name] += 1
-    st.session_state["previous_tag"]["image_name"] = image_name
-    st.session_state["previous_tag"]["image_id"] = image_id
-    st.session_state["previous_tag"]["tag_name"] = tag_name
+    if not isinstance(error, HttpError):
+        return True
 
-def undo_tag_image():
+    status = error.resp.status
+    if status == 429 or status >= 500:
+        return True
+    if status == 403:
+        try:
+            reason = json.loads(error.content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return False
+        return reason in RATE_LIMIT_REASONS
+    return False
+
+def rollback_tag_image(pending_tag, stats, consec, previous_tag,
+                       recent_image_ids):
+    """Roll back the session data of the given pending tag.
+
+    Used when the move of the pending tag fails permanently."""
+    image_id = pending_tag['image_id']
+    tag_name = pending_tag['tag_name']
+
+    stats[tag_name] -= 1
+    if consec["name"] == tag_name and consec["tot"] > 0:
+        consec["tot"] -= 1
+        if consec["tot"] == 0:
+            consec["name"] = None
+    if previous_tag["image_id"] == image_id:
+        previous_tag["image_name"] = None
+        previous_tag["image_id"] = None
+        previous_tag["tag_name"] = None
+    if image_id in recent_image_ids:
+        recent_image_ids.remove(image_id)
+
+def save_pending_tags(stats, consec, previous_tag, pending_tags,
+                      recent_image_ids):
+    """Save the given session pending tags to google drive.
+
+    The image moves are sent in a single batch request. The moves that
+    succeed are removed from the pending tags. A move that fails with a
+    transient error stays pending and is retried by the next save, a move
+    that fails permanently is dropped and rolled back, see
+    rollback_tag_image().
+
+    Return a list of the errors encountered.
+    """
+    errors = []
+    with pending_tags_lock():
+        if not pending_tags:
+            return errors
+
+        saved_indexes = set()
+        failed_indexes = set()
+
+        def batch_callback(request_id, response, exception):
+            """Record the outcome of the move with given request_id."""
+            if exception is None:
+                saved_indexes.add(int(request_id))
+            else:
+                errors.append(exception)
+                if not is_transient_drive_error(exception):
+                    failed_indexes.add(int(request_id))
+
+        batch = drive_service.new_batch_http_request(callback=batch_callback)
+        for index, pending_tag in enumerate(pending_tags):
+            batch.add(drive_files.update(
+                fileId=pending_tag['image_id'],
+                addParents=pending_tag['new_parent_folder_id'],
+                removeParents=pending_tag['curr_parent_folder_id'],
+                fields='id, parents'),
+                request_id=str(index))
+
+        try:
+            with drive_lock():
+                batch.execute()
+        except Exception as e:
+            # the batch itself failed, every move stays pending
+            errors.append(e)
+
+        for index in sorted(failed_indexes):
+            rollback_tag_image(pending_tags[index], stats, consec,
+                               previous_tag, recent_image_ids)
+
+        done_indexes = saved_indexes | failed_indexes
+        pending_tags[:] = [pending_tag
+                           for index, pending_tag in enumerate(pending_tags)
+                           if index not in done_indexes]
+
+    for error in errors:
+        print(f"DEBUG: pending tag not saved: {error}")
+    return errors
+
+def commit_pending_tags(stats, consec, previous_tag, pending_tags,
+                        recent_image_ids):
+    """Save the given session pending tags and report any errors."""
+    errors = save_pending_tags(stats, consec, previous_tag, pending_tags,
+                               recent_image_ids)
+    for error in errors:
+        st.error(f"Unexpected error encountered, {len(pending_tags)} tags "
+                 f"still pending: {error}")
+
+def schedule_pending_tags_save(session_data):
+    """Save the pending tags of the given session data once tagging pauses.
+
+    A timer thread saves the pending tags PENDING_TAGS_PAUSE seconds after
+    the latest run, so the tags are saved even if the user leaves the app.
+    The timer of an earlier run is cancelled."""
+    timer = st.session_state.pop("pending_tags_timer", None)
+    if timer is not None:
+        timer.cancel()
+
+    stats, consec, previous_tag, pending_tags, recent_image_ids = \
+        session_data
+    if pending_tags:
+        timer = threading.Timer(PENDING_TAGS_PAUSE, save_pending_tags,
+                                args=session_data)
+        timer.daemon = True
+        timer.start()
+        st.session_state["pending_tags_timer"] = timer
+
+def tagged_image_ids(pending_tags, recent_image_ids):
+    """Return a tuple of the image ids that are tagged but may still be
+    listed in the root folder.
+
+    These are the images of the given session pending_tags and
+    recent_image_ids, which google drive may list for a short time after
+    the move."""
+    image_ids = [pending_tag['image_id'] for pending_tag in pending_tags]
+    image_ids.extend(recent_image_ids)
+    return tuple(dict.fromkeys(image_ids))
+
+def undo_tag_image(stats, consec, previous_tag, pending_tags,
+                   recent_image_ids, cfg):
     """Undo previous tag of image.
 
-    Report progress using given tag_info_placeholder.
+    The given stats, consec, previous_tag, pending_tags and
+    recent_image_ids are the session data and are updated in place. The
+    folder ids are taken from the given cfg.
     """
-    if st.session_state["previous_tag"]["image_name"] is None:
+    if previous_tag["image_name"] is None:
         st.error("Nothing to undo")
         return
 
     # extract image data for undo from the session state "previous_tag" data
-    image_id = st.session_state["previous_tag"]["image_id"]
-    tag_name = st.session_state["previous_tag"]["tag_name"]
-    curr_parent_folder_id = tag_folder_ids_d[tag_name]
+    image_id = previous_tag["image_id"]
+    tag_name = previous_tag["tag_name"]
+    curr_parent_folder_id = cfg.tag_folder_ids_d[tag_name]
 
     # set new parent folder id (move the image back to the root folder)
-    new_parent_folder_id = CATMON_PICS_FOLDER_ID
-
-    # Move the image file to the selected tag folder
-    drive_service.files().update(
-        fileId=image_id,
-        addParents=new_parent_folder_id,
-        removeParents=curr_parent_folder_id,
-        fields='id, parents').execute()
-    time.sleep(1)
+    new_parent_folder_id = cfg.catmon_pics_folder_id
+
+    with pending_tags_lock():
+        pending_image_ids = [pending_tag['image_id']
+                             for pending_tag in pending_tags]
+        image_pending = image_id in pending_image_ids
+        if image_pending:
+            # the image has not been moved yet, drop the pending tag
+            del pending_tags[pending_image_ids.index(image_id)]
+
+    if not image_pending:
+        # Move the image file back to the root folder
+        with drive_lock():
+            drive_files.update(
+                fileId=image_id,
+                addParents=new_parent_folder_id,
+                removeParents=curr_parent_folder_id,
+                fields='id, parents').execute(num_retries=DRIVE_NUM_RETRIES)
 
     # update session data
-    st.session_state["stats"][tag_name] -= 1
-    st.session_state["consec"]["tot"] -= 1
-    if st.session_state["consec"]["tot"] == 0:
-        st.session_state["consec"]["name"] = "Undo"
-        st.session_state["consec"]["tot"] = 1
-
-    st.session_state["stats"]["Undo"] += 1
-    st.session_state["previous_tag"]["image_name"] = None
-    st.session_state["previous_tag"]["image_id"] = None
-    st.session_state["previous_tag"]["tag_name"] = None
-
-def download_drive_image(drive_service, file_id):
-    """Download image with given file_id using given drive_service"""
-    request = drive_service.files().get_media(fileId=file_id)
+    stats[tag_name] -= 1
+    consec["tot"] -= 1
+    if consec["tot"] == 0:
+        consec["name"] = "Undo"
+        consec["tot"] = 1
+
+    stats["Undo"] += 1
+    # the image is back in the root folder and may be listed again
+    recent_image_ids.remove(image_id)
+    previous_tag["image_name"] = None
+    previous_tag["image_id"] = None
+    previous_tag["tag_name"] = None
+
+@st.cache_data(ttl=600, max_entries=32, show_spinner=False)
+def fetch_drive_image_bytes(_drive_files, file_id):
+    """Download the bytes of image with given file_id using given
+    _drive_files.
+
+    The bytes are cached by file_id, so a rerun that shows the same image
+    makes no drive request."""
+    from googleapiclient.http import MediaIoBaseDownload
+
+    request = _drive_files.get_media(fileId=file_id)
 
     fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
+    downloader = MediaIoBaseDownload(fh, request,
+                                     chunksize=DOWNLOAD_CHUNK_SIZE)
     done = False
     while done is False:
-        status, done = downloader.next_chunk()
+        with drive_lock():
+            status, done = downloader.next_chunk(
+                num_retries=DRIVE_NUM_RETRIES)
         # print("Download %d%%" % int(status.progress() * 100))
 
-    return Image.open(fh)
+    return fh.getvalue()
+
+@st.cache_data(ttl=600, max_entries=32, show_spinner=False)
+def fetch_drive_image_head(_drive_files, file_id):
+    """Download the head bytes of image with given file_id using given
+    _drive_files.
+
+    The bytes are cached by file_id."""
+    request = _drive_files.get_media(fileId=file_id)
+    request.headers['Range'] = f'bytes=0-{IMAGE_HEAD_SIZE - 1}'
+    with drive_lock():
+        return request.execute(num_retries=DRIVE_NUM_RETRIES)
+
+def download_drive_image(drive_files, file_id):
+    """Download image with given file_id using given drive_files.
+
+    The image is reduced to the display size; for a jpeg the reduction is
+    applied while decoding."""
+    from PIL import Image
+
+    image_obj = Image.open(
+        io.BytesIO(fetch_drive_image_bytes(drive_files, file_id)))
+    image_obj.thumbnail(IMAGE_DISPLAY_SIZE, Image.BILINEAR)
+
+    return image_obj
+
+def download_drive_image_thumbnail(drive_files, file_id):
+    """Download the exif thumbnail of image with given file_id.
+
+    Only the head of the image is downloaded. The thumbnail is located
+    using the JPEGInterchangeFormat (offset) and JPEGInterchangeFormatLength
+    tags of the exif IFD1.
+    Return the thumbnail image object or None if there is no thumbnail."""
+    from PIL import ExifTags, Image
+
+    THUMBNAIL_OFFSET_TAG = 0x0201
+    THUMBNAIL_LENGTH_TAG = 0x0202
+    # the offset is relative to the tiff data after the 'Exif\0\0' header
+    EXIF_HEADER_SIZE = 6
+
+    head = fetch_drive_image_head(drive_files, file_id)
 
-def get_drive_image(drive_service):
+    try:
+        head_obj = Image.open(io.BytesIO(head))
+        ifd1 = head_obj.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset = ifd1.get(THUMBNAIL_OFFSET_TAG)
+        length = ifd1.get(THUMBNAIL_LENGTH_TAG)
+        if offset is None or length is None:
+            print(f"DEBUG: {file_id}, no exif thumbnail")
+            return None
+
+        start = EXIF_HEADER_SIZE + offset
+        thumbnail_obj = Image.open(
+            io.BytesIO(head_obj.info['exif'][start:start + length]))
+        thumbnail_obj.load()
+    except Exception as e:
+        print(f"DEBUG: {file_id}, exif thumbnail not read: {e}")
+        return None
+
+    return thumbnail_obj
+
+def get_drive_image(drive_files, cfg, skip_image_ids=()):
     """Download the next image file in catmon-pics folder.
 
-    Return the image_name, image_id and the image object"""
-    FILES_PER_PAGE = 1
+    The images with the given skip_image_ids, e.g. the tagged images, are
+    ignored.
+
+    Return a list of the dark images skipped, as tuples of image_name,
+    image_id and image brightness, and the image to tag, as a tuple of
+    image_name, image_id, image object and image brightness, or None. If
+    both are empty the folder has no image to tag."""
+    FILES_PER_PAGE = 5
+    MAX_PAGES = 2
+
+    # list a small window of the most recent images and walk it in order,
+    # so dark images are skipped without listing the folder again
+    # read one more for each image to be skipped
+    page_size = FILES_PER_PAGE + len(skip_image_ids)
+    dark_images = []
+    page_token = None
+    for _ in range(MAX_PAGES):
+        with drive_lock():
+            response = drive_files.list(
+                q=cfg.catmon_pics_query,
+                spaces='drive',
+                fields='nextPageToken,files(id,name)',
+                orderBy='createdTime desc',
+                pageSize=page_size,
+                pageToken=page_token).execute(
+                    num_retries=DRIVE_NUM_RETRIES)
+
+        for file in response.get('files', []):
+            # extract the image data
+            image_name = file.get('name')
+            image_id = file.get('id')
+            if image_id in skip_image_ids:
+                continue
+
+            # estimate the brightness from the thumbnail, so a clearly dark
+            # image is not downloaded
+            thumbnail_obj = download_drive_image_thumbnail(
+                drive_files, image_id)
+            if thumbnail_obj is None:
+                image_brightness = None
+            else:
+                image_brightness = brightness(thumbnail_obj)
+
+            # use the full image brightness if the estimate is borderline
+            if image_brightness is None or abs(
+                    image_brightness - IMAGE_BRIGHTNESS_THRESHOLD) <= \
+                    IMAGE_BRIGHTNESS_MARGIN:
+                image_brightness = brightness_dct(
+                    fetch_drive_image_bytes(drive_files, image_id))
+
+            print(f"DEBUG: {image_name}, brightness: {image_brightness}")
+            if image_brightness <= IMAGE_BRIGHTNESS_THRESHOLD:
+                # too dark to tag
+                dark_images.append((image_name, image_id, image_brightness))
+                continue
+
+            # download the image object
+            image_obj = download_drive_image(drive_files, image_id)
+
+            return dark_images, (image_name, image_id, image_obj,
+                                 image_brightness)
+
+        # return the dark images so that they are discarded before the next
+        # window is read
+        if dark_images:
+            break
 
-    # read next image file in root folder
-    query = f"'{CATMON_PICS_FOLDER_ID}' in parents and mimeType='image/jpeg'"
-    response = drive_service.files().list(
-        q=query,
-        spaces='drive',
-        fields='files(id, name)',
-        pageSize=FILES_PER_PAGE).execute()
+        # continue with the next page, at most once, if every image in the
+        # window is skipped
+        page_token = response.get('nextPageToken')
+        if page_token is None:
+            break
 
-    # extract the image data
-    file = response.get('files', [])[0]
-    image_name = file.get('name')
-    image_id = file.get('id')
+    return dark_images, None
 
-    # download the image object
-    image_obj = download_drive_image(drive_service, image_id)
+def prefetch_next_image(drive_files, cfg, image_id, skip_image_ids):
+    """Start downloading the image after the given image_id in the background.
 
-    return image_name, image_id, image_obj
+    The given skip_image_ids, i.e. the tagged images, are also skipped.
+
+    The prefetch is stored in the session state and is used by the next
+    run if the given image has been tagged, see take_prefetched_image().
+    A prefetch that already skips the given image_id is kept."""
+    prefetch = st.session_state.get("prefetch")
+    if prefetch is not None and prefetch['skip_image_id'] == image_id:
+        return
+
+    future = prefetch_executor().submit(
+        get_drive_image, drive_files, cfg,
+        skip_image_ids=skip_image_ids + (image_id,))
+    st.session_state["prefetch"] = {
+        'skip_image_id': image_id,
+        'future': future
+        }
+
+def take_prefetched_image(previous_tag):
+    """Return the prefetched image data or None if it cannot be used.
+
+    The prefetched image is only valid if the image it skipped, i.e. the
+    image shown on the previous run, is the given previous_tag image.
+    Otherwise the prefetch is left in the session state, as the same image
+    is likely shown again, see prefetch_next_image()."""
+    prefetch = st.session_state.get("prefetch")
+    if prefetch is None or \
+            prefetch['skip_image_id'] != previous_tag["image_id"]:
+        return None
+
+    del st.session_state["prefetch"]
+    try:
+        return prefetch['future'].result(timeout=PREFETCH_TIMEOUT)
+    except Exception as e:
+        print(f"DEBUG: prefetch failed, using synchronous download: {e}")
+        return None
 
 def brightness(image_obj):
     """Calculate the perceived brightness of a given image object.
@@ -288,57 +720,95 @@ def brightness(image_obj):
 
     "The three constants (.299, .587, and .114) represent the different
     degrees to which each of the primary (RGB) colors affects human
-    perception of the overall brightness of a color."""
-    R_CONST = 0.299
-    G_CONST = 0.587
-    B_CONST = 0.114
-    stat = ImageStat.Stat(image_obj)
-    r, g, b = stat.mean
-    return math.sqrt(R_CONST*(r**2) + G_CONST*(g**2) + B_CONST*(b**2))
+    perception of the overall brightness of a color."
+
+    The constants are held in BRIGHTNESS_WEIGHTS. The channel means are
+    calculated on a small thumbnail of the image, which gives the same
+    result to within a fraction of a percent."""
+    from PIL import Image
+
+    THUMBNAIL_SIZE = (32, 32)
+    thumbnail_obj = image_obj.resize(THUMBNAIL_SIZE, Image.BILINEAR)
+    pixels = np.asarray(thumbnail_obj.convert('RGB'), dtype=np.float32)
+    means = pixels.reshape(-1, 3).mean(axis=0)
+    return float(np.sqrt((means*means) @ BRIGHTNESS_WEIGHTS))
+
+def brightness_dct(image_bytes):
+    """Calculate the perceived brightness of the given jpeg image bytes.
+
+    The image is decoded at 1/8 scale, at which libjpeg uses only the DC
+    coefficient, i.e. the average, of each 8x8 block and skips the inverse
+    DCT. An image that is not a jpeg is decoded in full.
+
+    Return the brightness as calculated by brightness()."""
+    from PIL import Image
+
+    image_obj = Image.open(io.BytesIO(image_bytes))
+    image_obj.draft('RGB', (image_obj.width // 8, image_obj.height // 8))
+    return brightness(image_obj)
 
 
 if check_password():
     st.title("Catmon Image Tagging App")
 
     # connect to gdrive and get the next image
-    drive_service = gdrive_connect()
+    drive_service, drive_files = gdrive_connect()
+    cfg = config()
+
+    # bind the session data once per run
+    ss = st.session_state
+    stats = ss["stats"]
+    consec = ss["consec"]
+    previous_tag = ss["previous_tag"]
+    pending_tags = ss["pending_tags"]
+    recent_image_ids = ss["recent_image_ids"]
+    session_data = (stats, consec, previous_tag, pending_tags,
+                    recent_image_ids)
 
     # define columns for user image tagging
     col1, col2, col3 = st.columns([0.6, 3, 3])
     col4, col5, col6, col7 = st.columns([1, 1, 1, 3])
 
-    # get image to tag
+    # get image to tag, using the prefetched image if available
+    first_attempt = True
     image_not_ready = True
-    duplicate = 0
     while image_not_ready:
         with st.spinner('Loading next image to tag...'):
-            image_name, image_id, image_obj = get_drive_image(drive_service)
+            # waiting for the prefetch may take a while, so do it here
+            prefetched_image = None
+            if first_attempt:
+                prefetched_image = take_prefetched_image(previous_tag)
+                first_attempt = False
+
+            if prefetched_image is not None:
+                dark_images, drive_image = prefetched_image
+            else:
+                dark_images, drive_image = get_drive_image(
+                    drive_files, cfg,
+                    skip_image_ids=tagged_image_ids(pending_tags,
+                                                    recent_image_ids))
 
-            # get another image if duplicate
-            if image_id == st.session_state["previous_tag"]["image_id"]:
-                duplicate += 1
-                print(f"DEBUG: {image_name}, duplicate {duplicate}")
-                with col2.empty():
-                    st.write(
-                        f"Duplicate image found: {image_name}, requesting "
-                        f"another ({duplicate})...)"
-                        )
-                    if duplicate < 3:
-                        time.sleep(1)
-                        st.empty()
-                        continue
-
-            # auto discard image if too dark
-            image_brightness = brightness(image_obj)
-            print(f"DEBUG: {image_name}, brightness: {image_brightness}")
-            if image_brightness <= IMAGE_BRIGHTNESS_THRESHOLD:
+            # auto discard images that are too dark
+            for image_name, image_id, image_brightness in dark_images:
                 with col2.empty():
                     st.write(f"Auto-discarding dark image {image_name})")
-                    tag_image(image_name, image_id, 'Auto-Discard')
-                    time.sleep(1)
+                    tag_image(image_name, image_id, 'Auto-Discard',
+                              *session_data, cfg)
                     st.empty()
-            else:
+
+            if drive_image is not None:
+                image_name, image_id, image_obj, image_brightness = \
+                    drive_image
                 image_not_ready = False
+            elif not dark_images:
+                # stop if there are no more images to tag
+                commit_pending_tags(*session_data)
+                st.write("No more images to tag")
+                st.stop()
+
+    # start fetching the next image while the user tags this one
+    prefetch_next_image(drive_files, cfg, image_id,
+                        tagged_image_ids(pending_tags, recent_image_ids))
 
     with col1:
         st.button(
@@ -346,11 +816,11 @@ if check_password():
             key='btn_boo',
             help='Press this button to tag the image as Boo',
             on_click=tag_image,
-            args=(image_name, image_id, 'Boo')
+            args=(image_name, image_id, 'Boo', *session_data, cfg)
             )
 
     with col2:
-        st.image(image_obj, caption=image_name)
+        st.image(image_obj, caption=image_name, output_format='JPEG')
         st.empty()
 
     with col3:
@@ -359,7 +829,7 @@ if check_password():
             key='btn_simba',
             help='Press this button to tag the image as Simba',
             on_click=tag_image,
-            args=(image_name, image_id, 'Simba')
+            args=(image_name, image_id, 'Simba', *session_data, cfg)
             )
 
     with col5:
@@ -368,7 +838,7 @@ if check_password():
             key='btn_unclear',
             help='Press this button if there is no clear cat!',
             on_click=tag_image,
-            args=(image_name, image_id, 'Unclear')
+            args=(image_name, image_id, 'Unclear', *session_data, cfg)
             )
 
     with col6:
@@ -377,28 +847,39 @@ if check_password():
             key='btn_undo',
             help='Press this button to undo the previous action',
             on_click=undo_tag_image,
-            args=()
+            args=(*session_data, cfg)
+            )
+
+    with col7:
+        st.button(
+            label='Commit',
+            key='btn_commit',
+            help='Press this button to save the pending tags to google drive',
+            on_click=commit_pending_tags,
+            args=session_data
             )
 
     # debug: show consec stats
     # st.write("consec stats")
-    # st.write(st.session_state["consec"])
+    # st.write(consec)
 
     # show tagging stats
     st.subheader("Tag Metrics")
     col7, col8, col9, col10, col11 = st.columns(5)
-    delta_calc = lambda tag: st.session_state["consec"]["tot"] \
-            if tag == st.session_state["consec"]["name"] else None
-    col7.metric("Boo count", st.session_state["stats"]["Boo"],
-                delta=delta_calc("Boo"))
-    col8.metric("Simba count", st.session_state["stats"]["Simba"],
-                delta=delta_calc("Simba"))
-    col9.metric("Unclear count", st.session_state["stats"]["Unclear"],
-                delta=delta_calc("Unclear"))
-    col10.metric("Auto-Discard count", st.session_state["stats"]["Auto-Discard"],
-                delta=delta_calc("Auto-Discard"))
-    col11.metric("Undo count", st.session_state["stats"]["Undo"],
-                 delta=delta_calc("Undo"))
+    # the delta shows the consecutive total of the current tag only
+    consec_name = consec["name"]
+    consec_tot = consec["tot"]
+    deltas = {tag: (consec_tot if tag == consec_name else None)
+              for tag in stats}
+    col7.metric("Boo count", stats["Boo"], delta=deltas["Boo"])
+    col8.metric("Simba count", stats["Simba"], delta=deltas["Simba"])
+    col9.metric("Unclear count", stats["Unclear"], delta=deltas["Unclear"])
+    col10.metric("Auto-Discard count", stats["Auto-Discard"],
+                 delta=deltas["Auto-Discard"])
+    col11.metric("Undo count", stats["Undo"], delta=deltas["Undo"])
+
+    # save the pending tags if tagging pauses
+    schedule_pending_tags_save(session_data)
 
 # show guidelines
     with st.expander("Tagging Guidelines", expanded=True):
@@ -409,3 +890,7 @@ if check_password():
                     a very dark image where a cat is not clearly visible.""")
         st.markdown("""- The tagging of the previous image can be undone.
                     You can only go back one step.""")
+        st.markdown(f"""- Tags are saved to google drive in batches of
+                    {PENDING_TAGS_FLUSH_SIZE}, or after a
+                    {PENDING_TAGS_PAUSE} second pause in tagging.
+                    Press Commit to save the pending tags now.""")